@@ -1,16 +1,92 @@
 #! /usr/bin/env python
 
 import argparse
+import asyncio
+import hashlib
 import os
-import urllib.request
-import urllib.error
-import json
+from functools import lru_cache
+from pathlib import Path
+from typing import AsyncIterator, Callable, Iterator, Optional, Union
+
+import httpx
+import orjson
+from tenacity import RetryCallState, retry, retry_if_exception, stop_after_attempt, wait_exponential
 
 
 # Constants
 GITEA_BASE_URL = 'https://gitea.mavolk.de/api/v1/repos/max/python-rq-encoding'
 OPENROUTER_URL = "https://openrouter.ai/api/v1/chat/completions"
 DEFAULT_MODEL = "z-ai/glm-4.7"
+REQUEST_TIMEOUT = httpx.Timeout(30.0, connect=5.0)
+# Generating a review can take minutes; the POST is not retried on timeout
+REVIEW_TIMEOUT = httpx.Timeout(600.0, connect=5.0)
+CACHE_DIR = Path.home() / '.cache' / 'pr-bot'
+ETAGS_FILE = CACHE_DIR / 'etags.json'
+BODY_CHUNK_SIZE = 64 * 1024
+
+# The review prompt wrapped around the diff
+PROMPT_HEADER = """
+                You are a senior software engineer reviewing a code change.
+                Analyze the following changes and provide a structured review:
+                """
+PROMPT_FOOTER = """
+                """
+
+
+def create_client(headers: dict, base_url: str = '',
+                  timeout: httpx.Timeout = REQUEST_TIMEOUT) -> httpx.AsyncClient:
+    """
+    Create an HTTP client for one API host.
+
+    Headers set on the client are sent with every request; over HTTP/2 they
+    are compressed with HPACK, so repeated auth headers cost almost nothing.
+
+    Args:
+        headers: Headers sent with every request, such as authentication
+        base_url: Prefix for relative request URLs
+        timeout: Timeouts applied to every request
+
+    Returns:
+        An HTTP/2 client with keep-alive connection pooling
+    """
+    transport = httpx.AsyncHTTPTransport(
+        http2=True,
+        limits=httpx.Limits(max_keepalive_connections=20)
+    )
+    return httpx.AsyncClient(transport=transport, headers=headers, base_url=base_url, timeout=timeout)
+
+
+def create_gitea_client(api_token: str) -> httpx.AsyncClient:
+    """
+    Create the HTTP client for the Gitea API.
+
+    Args:
+        api_token: Gitea API token for authentication
+
+    Returns:
+        A client whose relative URLs resolve against GITEA_BASE_URL
+    """
+    headers = {
+        'accept': 'application/json',
+        'Authorization': f'token {api_token}'
+    }
+    return create_client(headers, GITEA_BASE_URL)
+
+
+def create_openrouter_client(api_token: str) -> httpx.AsyncClient:
+    """
+    Create the HTTP client for the OpenRouter API.
+
+    Args:
+        api_token: OpenRouter API token
+
+    Returns:
+        A client authenticated against OpenRouter
+    """
+    headers = {
+        "Authorization": f"Bearer {api_token}"
+    }
+    return create_client(headers, timeout=REVIEW_TIMEOUT)
 
 
 class BotError(Exception):
@@ -37,43 +113,291 @@ def get_env_var(name: str) -> str:
     return value
 
 
-def get_pull_request_diff(pr_number: int, api_token: str) -> str:
+def write_cache_file(path: Path, data: bytes) -> None:
+    """
+    Atomically write an entry to the on-disk cache.
+
+    Args:
+        path: Destination of the cache entry
+        data: Content to store
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f'.{path.name}.{os.getpid()}.tmp')
+    tmp_path.write_bytes(data)
+    tmp_path.replace(path)
+
+
+def load_diff_etags() -> dict:
+    """
+    Read the last known diff ETag of each pull request.
+
+    Returns:
+        Mapping of pull request number (as a string) to ETag
+    """
+    try:
+        return orjson.loads(ETAGS_FILE.read_bytes())
+    except (FileNotFoundError, orjson.JSONDecodeError):
+        return {}
+
+
+def store_diff_etag(pr_number: int, response: httpx.Response) -> None:
+    """
+    Remember a diff response for conditional requests, if it has an ETag.
+
+    Args:
+        pr_number: The pull request number
+        response: The successful diff response
+    """
+    etag = response.headers.get('ETag')
+    if not etag:
+        return
+    write_cache_file(CACHE_DIR / 'diffs' / f'{pr_number}.diff', response.content)
+    etags = load_diff_etags()
+    etags[str(pr_number)] = etag
+    write_cache_file(ETAGS_FILE, orjson.dumps(etags))
+
+
+def is_transient_error(error: BaseException) -> bool:
+    """
+    Decide whether a failed request is worth retrying.
+
+    Connect and pool errors mean the request was never sent, so it is always
+    safe to resend. Other transport errors (such as read timeouts) may hit a
+    request the server is still processing; only idempotent GETs are retried
+    then, so a slow review POST is not paid for again.
+
+    Args:
+        error: The exception raised by the request
+
+    Returns:
+        True for failures worth another attempt
+    """
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code >= 500
+    if isinstance(error, (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)):
+        return True
+    if not isinstance(error, httpx.TransportError):
+        return False
+    try:
+        return error.request.method == 'GET'
+    except RuntimeError:
+        # No request attached to the error
+        return False
+
+
+def log_retry(retry_state: RetryCallState) -> None:
+    """
+    Report a failed attempt before backing off.
+
+    Args:
+        retry_state: State of the request being retried
+    """
+    error = retry_state.outcome.exception()
+    if isinstance(error, httpx.HTTPStatusError):
+        reason = f"HTTP {error.response.status_code} from {error.request.url}"
+    else:
+        reason = str(error) or type(error).__name__
+    print(f"Request failed ({reason}), retrying in {retry_state.next_action.sleep:.1f}s")
+
+
+@retry(
+    stop=stop_after_attempt(4),
+    wait=wait_exponential(multiplier=0.5, max=8),
+    retry=retry_if_exception(is_transient_error),
+    before_sleep=log_retry,
+    reraise=True
+)
+async def send_request(client: httpx.AsyncClient, method: str, url: str, headers: Optional[dict] = None,
+                       content: Union[bytes, Callable[[], AsyncIterator[bytes]], None] = None) -> httpx.Response:
+    """
+    Send a request, retrying transient failures with exponential backoff.
+
+    Args:
+        client: HTTP client used for the request
+        method: HTTP method
+        url: Request URL, relative to the client's base URL
+        headers: Extra headers for this request
+        content: Request body, or a function returning a fresh body stream
+            for each attempt (a consumed stream cannot be resent)
+
+    Returns:
+        A successful or 304 Not Modified response
+
+    Raises:
+        httpx.HTTPError: If the request still fails after retrying
+    """
+    if callable(content):
+        content = content()
+    response = await client.request(method, url, headers=headers, content=content)
+    if response.status_code != httpx.codes.NOT_MODIFIED:
+        response.raise_for_status()
+    return response
+
+
+async def get_pull_request_head_sha(client: httpx.AsyncClient, pr_number: int) -> str:
+    """
+    Fetch the commit SHA at the head of a pull request.
+
+    Args:
+        client: Gitea HTTP client used for the request
+        pr_number: The pull request number
+
+    Returns:
+        The head commit SHA
+
+    Raises:
+        BotError: If fetching the pull request fails
+    """
+    try:
+        response = await send_request(client, 'GET', f'/pulls/{pr_number}')
+        return orjson.loads(response.content)["head"]["sha"]
+    except httpx.HTTPError as e:
+        raise BotError(f"Failed to fetch pull request #{pr_number}: {e}")
+    except (orjson.JSONDecodeError, KeyError, TypeError) as e:
+        raise BotError(f"Unexpected pull request response for #{pr_number}: {e}")
+
+
+async def get_pull_request_diff(client: httpx.AsyncClient, pr_number: int, use_cache: bool = True) -> bytes:
     """
     Fetch the diff from a pull request.
 
+    If the server sent an ETag for the last diff of this pull request, the
+    diff is requested with If-None-Match and a 304 reuses the cached copy
+    without transferring it again. Otherwise the diff is cached on disk
+    keyed by the pull request's head commit, so reruns against an unchanged
+    pull request only fetch the small pull request metadata.
+
     Args:
+        client: Gitea HTTP client used for the request
         pr_number: The pull request number to review
-        api_token: Gitea API token for authentication
+        use_cache: If False, ignore any cached diff and refresh the cache entry
 
     Returns:
-        The diff content as a string
+        The raw UTF-8 diff content
 
     Raises:
         BotError: If fetching the diff fails
     """
-    url = f'{GITEA_BASE_URL}/pulls/{pr_number}.diff'
-    headers = {
-        'accept': 'application/json',
-        'Authorization': f'token {api_token}'
-    }
-    req = urllib.request.Request(url, headers=headers)
+    url = f'/pulls/{pr_number}.diff'
+    etag_file = CACHE_DIR / 'diffs' / f'{pr_number}.diff'
+    etag = load_diff_etags().get(str(pr_number)) if use_cache and etag_file.is_file() else None
+    if etag:
+        try:
+            response = await send_request(client, 'GET', url, headers={'If-None-Match': etag})
+            if response.status_code == 304:
+                return etag_file.read_bytes()
+        except httpx.HTTPError as e:
+            raise BotError(f"Failed to fetch pull request diff: {e}")
+
+        store_diff_etag(pr_number, response)
+        return response.content
+
+    head_sha = await get_pull_request_head_sha(client, pr_number)
+    cache_file = CACHE_DIR / 'diffs' / f'{pr_number}-{head_sha}.diff'
+    if use_cache and cache_file.is_file():
+        return cache_file.read_bytes()
 
     try:
-        with urllib.request.urlopen(req) as response:
-            return response.read().decode('utf-8')
-    except urllib.error.URLError as e:
+        response = await send_request(client, 'GET', url)
+    except httpx.HTTPError as e:
         raise BotError(f"Failed to fetch pull request diff: {e}")
 
+    write_cache_file(cache_file, response.content)
+    store_diff_etag(pr_number, response)
+    return response.content
+
+
+def iter_json_string(data: bytes, chunk_size: int = BODY_CHUNK_SIZE) -> Iterator[bytes]:
+    """
+    Escape UTF-8 text for embedding in a JSON string, chunk by chunk.
+
+    Chunks are split after a newline so no multi-byte character is cut in
+    half, and only one chunk is ever held in escaped form.
+
+    Args:
+        data: The UTF-8 text to escape
+        chunk_size: Approximate number of input bytes per chunk
+
+    Yields:
+        JSON-escaped chunks without the surrounding quotes
+    """
+    view = memoryview(data)
+    start = 0
+    while start < len(data):
+        end = data.find(b'\n', start + chunk_size)
+        end = len(data) if end == -1 else end + 1
+        yield orjson.dumps(str(view[start:end], 'utf-8'))[1:-1]
+        start = end
+
+
+@lru_cache(maxsize=None)
+def review_body_template(model: str) -> tuple[bytes, bytes]:
+    """
+    Pre-serialize the constant parts of the OpenRouter request body.
+
+    Args:
+        model: The model to use
+
+    Returns:
+        The JSON bytes before and after the escaped diff
+    """
+    placeholder = "\0"
+    envelope = orjson.dumps({"model": model, "messages": [{"role": "user", "content": placeholder}]})
+    prefix, suffix = envelope.split(orjson.dumps(placeholder))
+    return prefix + orjson.dumps(PROMPT_HEADER)[:-1], orjson.dumps(PROMPT_FOOTER)[1:] + suffix
+
+
+async def iter_review_body(model: str, diff: bytes) -> AsyncIterator[bytes]:
+    """
+    Stream the OpenRouter request body for reviewing a diff.
+
+    Args:
+        model: The model to use
+        diff: The raw UTF-8 diff content
+
+    Yields:
+        Consecutive chunks of the JSON request body
+    """
+    prefix, suffix = review_body_template(model)
+    yield prefix
+    for chunk in iter_json_string(diff):
+        yield chunk
+    yield suffix
+
+
+def is_complete_review(response: object) -> bool:
+    """
+    Check that an OpenRouter response carries a review and its cost.
+
+    Args:
+        response: Parsed JSON response from OpenRouter
+
+    Returns:
+        True if the review text and cost can be extracted
+    """
+    try:
+        return (isinstance(response["choices"][0]["message"]["content"], str)
+                and response["usage"]["cost"] is not None)
+    except (KeyError, IndexError, TypeError):
+        return False
+
 
-def send_to_openrouter(diff: str, api_token: str, model: str = DEFAULT_MODEL, verbose: bool = False) -> dict:
+async def send_to_openrouter(client: httpx.AsyncClient, diff: bytes, model: str = DEFAULT_MODEL,
+                             verbose: bool = False, use_cache: bool = True) -> dict:
     """
     Send the diff to OpenRouter API for code review.
 
+    Responses are cached on disk keyed by a hash of the model and prompt, so
+    rerunning the bot on an unchanged diff does not pay for a second review.
+    The request body is streamed around the diff bytes instead of building
+    the prompt and its JSON encoding in memory.
+
     Args:
-        diff: The pull request diff content
-        api_token: OpenRouter API token
+        client: OpenRouter HTTP client used for the request
+        diff: The raw UTF-8 pull request diff
         model: The model to use (default: z-ai/glm-4.7)
         verbose: If True, print detailed response information
+        use_cache: If False, ignore any cached review and refresh the cache entry
 
     Returns:
         Parsed JSON response from OpenRouter
@@ -82,57 +406,60 @@ def send_to_openrouter(diff: str, api_token: str, model: str = DEFAULT_MODEL, ve
         BotError: If the API request fails
     """
     headers = {
-        "Authorization": f"Bearer {api_token}",
         "Content-Type": "application/json"
     }
-    data = {
-        "model": model,
-        "messages": [
-            {
-                "role": "user",
-                "content": f"""
-                You are a senior software engineer reviewing a code change.
-                Analyze the following changes and provide a structured review:
-                {diff}
-                """
-            }
-        ]
-    }
-    json_data = json.dumps(data).encode('utf-8')
-    req = urllib.request.Request(
-        OPENROUTER_URL,
-        data=json_data,
-        headers=headers,
-        method="POST"
-    )
+
+    prompt_hash = hashlib.sha256(f"{model}\0{PROMPT_HEADER}".encode('utf-8'))
+    prompt_hash.update(diff)
+    prompt_hash.update(PROMPT_FOOTER.encode('utf-8'))
+    cache_key = prompt_hash.hexdigest()
+    cache_file = CACHE_DIR / 'reviews' / f'{cache_key}.json'
+    if use_cache and cache_file.is_file():
+        try:
+            cached = orjson.loads(cache_file.read_bytes())
+            if is_complete_review(cached):
+                print("Using cached OpenRouter review")
+                return cached
+        except orjson.JSONDecodeError:
+            pass
 
     try:
-        with urllib.request.urlopen(req) as response:
-            response_data = response.read().decode('utf-8')
-            if verbose:
-                print("Success! Response:")
-                print(json.dumps(json.loads(response_data), indent=2))
-            else:
-                print("Successfully sent diff to OpenRouter for review")
-            return json.loads(response_data)
-    except urllib.error.HTTPError as e:
-        error_body = e.read().decode('utf-8')
-        raise BotError(f"HTTP Error {e.code} - {e.reason}: {error_body}")
-    except urllib.error.URLError as e:
-        raise BotError(f"URL Error: {e.reason}")
-    except json.JSONDecodeError as e:
+        response = await send_request(client, 'POST', OPENROUTER_URL, headers=headers,
+                                      content=lambda: iter_review_body(model, diff))
+        parsed = orjson.loads(response.content)
+        if verbose:
+            print("Success! Response:")
+            print(orjson.dumps(parsed, option=orjson.OPT_INDENT_2).decode('utf-8'))
+        else:
+            print("Successfully sent diff to OpenRouter for review")
+    except httpx.HTTPStatusError as e:
+        raise BotError(f"HTTP Error {e.response.status_code} - {e.response.reason_phrase}: {e.response.text}")
+    except httpx.HTTPError as e:
+        raise BotError(f"URL Error: {e}")
+    except UnicodeDecodeError as e:
+        raise BotError(f"Pull request diff is not valid UTF-8: {e}")
+    except orjson.JSONDecodeError as e:
         raise BotError(f"Failed to parse JSON response: {e}")
 
+    # Only cache real reviews; an error body (which OpenRouter may send with
+    # status 200) would otherwise be replayed on every rerun
+    if not is_complete_review(parsed):
+        error = parsed.get("error", parsed) if isinstance(parsed, dict) else parsed
+        raise BotError(f"OpenRouter response has no review: {error}")
+    write_cache_file(cache_file, response.content)
+    return parsed
+
 
-def add_comment_to_issue(issue_number: int, review_text: str, cost: str, api_token: str, verbose: bool = False) -> dict:
+async def add_comment_to_issue(client: httpx.AsyncClient, issue_number: int, review_text: str, cost: str,
+                               verbose: bool = False) -> dict:
     """
     Post the review as a comment to an issue.
 
     Args:
+        client: Gitea HTTP client used for the request
         issue_number: The issue number to comment on
         review_text: The review content from OpenRouter
         cost: The cost information from OpenRouter response
-        api_token: Gitea API token for authentication
         verbose: If True, print detailed response information
 
     Returns:
@@ -141,49 +468,73 @@ def add_comment_to_issue(issue_number: int, review_text: str, cost: str, api_tok
     Raises:
         BotError: If posting the comment fails
     """
-    url = f'{GITEA_BASE_URL}/issues/{issue_number}/comments'
     headers = {
-        'accept': 'application/json',
-        'Content-Type': 'application/json',
-        'Authorization': f'token {api_token}'
+        'Content-Type': 'application/json'
     }
-    payload = json.dumps({"body": f"Review:\n{review_text}\nCost:{cost}"}).encode('utf-8')
-    req = urllib.request.Request(
-        url=url,
-        data=payload,
-        headers=headers,
-        method='POST'
-    )
+    payload = orjson.dumps({"body": f"Review:\n{review_text}\nCost:{cost}"})
 
     try:
-        with urllib.request.urlopen(req) as response:
-            response_body = response.read().decode('utf-8')
-            response_status = response.status
-            response_headers = dict(response.getheaders())
-
-            if verbose:
-                print(f"Status: {response_status}")
-                print("Response headers:")
-                for key, value in response_headers.items():
-                    print(f"  {key}: {value}")
-                print("\nResponse body:")
-                print(response_body)
-
-            try:
-                json_response = json.loads(response_body)
-                if verbose:
-                    print("\nParsed JSON response:")
-                    print(json.dumps(json_response, indent=2))
-                else:
-                    print(f"Successfully posted review comment to issue #{issue_number}")
-                return json_response
-            except json.JSONDecodeError:
-                return {"raw_response": response_body}
-    except urllib.error.HTTPError as e:
-        error_body = e.read().decode('utf-8')
-        raise BotError(f"HTTP Error {e.code} - {e.reason}: {error_body}")
-    except urllib.error.URLError as e:
-        raise BotError(f"URL/Connection Error: {e.reason}")
+        response = await send_request(client, 'POST', f'/issues/{issue_number}/comments', headers=headers,
+                                      content=payload)
+    except httpx.HTTPStatusError as e:
+        raise BotError(f"HTTP Error {e.response.status_code} - {e.response.reason_phrase}: {e.response.text}")
+    except httpx.HTTPError as e:
+        raise BotError(f"URL/Connection Error: {e}")
+
+    response_body = response.text
+    if verbose:
+        print(f"Status: {response.status_code}")
+        print("Response headers:")
+        for key, value in response.headers.items():
+            print(f"  {key}: {value}")
+        print("\nResponse body:")
+        print(response_body)
+
+    try:
+        json_response = orjson.loads(response.content)
+        if verbose:
+            print("\nParsed JSON response:")
+            print(orjson.dumps(json_response, option=orjson.OPT_INDENT_2).decode('utf-8'))
+        else:
+            print(f"Successfully posted review comment to issue #{issue_number}")
+        return json_response
+    except orjson.JSONDecodeError:
+        return {"raw_response": response_body}
+
+
+async def review_one(gitea: httpx.AsyncClient, openrouter: httpx.AsyncClient, pr_number: int, issue_number: int,
+                     model: str = DEFAULT_MODEL, verbose: bool = False, use_cache: bool = True) -> dict:
+    """
+    Review a single pull request and post the result as a comment.
+
+    Args:
+        gitea: Gitea HTTP client
+        openrouter: OpenRouter HTTP client
+        pr_number: The pull request number to review
+        issue_number: The issue number to comment on
+        model: The model to use (default: z-ai/glm-4.7)
+        verbose: If True, print detailed response information
+        use_cache: If False, bypass the on-disk diff and review caches
+
+    Returns:
+        Parsed JSON response from Gitea
+
+    Raises:
+        BotError: If any step of the review fails
+    """
+    # Get pull request diff
+    diff = await get_pull_request_diff(gitea, pr_number, use_cache)
+
+    # Send to OpenRouter for review
+    response = await send_to_openrouter(openrouter, diff, model, verbose, use_cache)
+
+    # Extract review and cost
+    review_text = response["choices"][0]["message"]["content"]
+    cost = response["usage"]["cost"]
+
+    # Add comment to issue. The review is already cached on disk at this
+    # point, so if posting fails a rerun does not pay for a second review.
+    return await add_comment_to_issue(gitea, issue_number, review_text, cost, verbose)
 
 
 def handle_error(error: Exception, context: str) -> None:
@@ -198,22 +549,24 @@ def handle_error(error: Exception, context: str) -> None:
     exit(1)
 
 
-def main() -> None:
+async def main() -> None:
     """Orchestrate the entire workflow."""
     parser = argparse.ArgumentParser(
-        description="Review a pull request using OpenRouter and post the review as a comment."
+        description="Review pull requests using OpenRouter and post each review as a comment."
     )
     parser.add_argument(
         '-p', '--pr-number',
         type=int,
+        nargs='+',
         required=True,
-        help='Pull request number to review'
+        help='Pull request number(s) to review'
     )
     parser.add_argument(
         '-i', '--issue-number',
         type=int,
+        nargs='+',
         required=True,
-        help='Issue number to comment on'
+        help='Issue number(s) to comment on, one per pull request'
     )
     parser.add_argument(
         '-m', '--model',
@@ -226,26 +579,36 @@ def main() -> None:
         action='store_true',
         help='Print detailed response information'
     )
+    parser.add_argument(
+        '--no-cache',
+        action='store_true',
+        help=f'Ignore cached diffs and reviews in {CACHE_DIR}'
+    )
 
     args = parser.parse_args()
+    if len(args.pr_number) != len(args.issue_number):
+        parser.error("--pr-number and --issue-number must be given the same number of times")
+    pairs = list(zip(args.pr_number, args.issue_number))
 
     try:
         # Get API tokens from environment variables
         gitea_token = get_env_var('GITEA_TOKEN')
         openrouter_token = get_env_var('OPENROUTER_TOKEN')
 
-        # Get pull request diff
-        diff = get_pull_request_diff(args.pr_number, gitea_token)
-
-        # Send to OpenRouter for review
-        response = send_to_openrouter(diff, openrouter_token, args.model, args.verbose)
-
-        # Extract review and cost
-        review_text = response["choices"][0]["message"]["content"]
-        cost = response["usage"]["cost"]
-
-        # Add comment to issue
-        add_comment_to_issue(args.issue_number, review_text, cost, gitea_token, args.verbose)
+        # Review all pull requests concurrently, one connection pool per host
+        async with create_gitea_client(gitea_token) as gitea:
+            async with create_openrouter_client(openrouter_token) as openrouter:
+                results = await asyncio.gather(
+                    *[review_one(gitea, openrouter, pr, issue, args.model, args.verbose, not args.no_cache)
+                      for pr, issue in pairs],
+                    return_exceptions=True
+                )
+
+        failures = [(pr, result) for (pr, _), result in zip(pairs, results) if isinstance(result, Exception)]
+        for pr, error in failures:
+            print(f"Error in review of pull request #{pr}: {error}")
+        if failures:
+            raise BotError(f"{len(failures)} of {len(pairs)} reviews failed")
 
     except BotError as e:
         handle_error(e, "bot operation")
@@ -254,4 +617,4 @@ def main() -> None:
 
 
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())
@@ -3,20 +3,282 @@
 Ultra-fast batch resizer for same-resolution images with GPU acceleration
 """
 
+import io
 import os
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from PIL import Image
 import torch
-import torchvision.transforms as transforms
+from torchvision.io import ImageReadMode, decode_jpeg, encode_jpeg, read_file, write_file
 from torchvision.transforms.functional import resize
+from torch.utils.data import DataLoader, Dataset
+from tqdm import tqdm
 import time
 import numpy as np
 
+# JPEGs can be decoded and encoded by torchvision.io (nvJPEG on the GPU)
+JPEG_EXTENSIONS = {'.jpg', '.jpeg'}
+
+class ImageFolderDataset(Dataset):
+    """
+    Decodes same-resolution image files into uint8 RGB batches
+
+    The DataLoader fetches whole batches through __getitems__, which decodes
+    straight into one preallocated tensor instead of stacking per-image ones.
+    With gpu_jpeg set, JPEG files are returned as raw file bytes (1-D uint8
+    tensors) so they can be decoded on the GPU; other formats use PIL.
+    """
+    def __init__(self, image_files, image_size, gpu_jpeg=False):
+        self.image_files = image_files
+        self.image_size = image_size
+        self.gpu_jpeg = gpu_jpeg
+
+    def __len__(self):
+        return len(self.image_files)
+
+    def __getitem__(self, idx):
+        return self.__getitems__([idx])
+
+    def __getitems__(self, indices):
+        width, height = self.image_size
+        paths = [self.image_files[idx] for idx in indices]
+        if self.gpu_jpeg:
+            jpeg_paths = [p for p in paths if p.suffix.lower() in JPEG_EXTENSIONS]
+            pil_paths = [p for p in paths if p.suffix.lower() not in JPEG_EXTENSIONS]
+        else:
+            jpeg_paths, pil_paths = [], paths
+        
+        # Only allocate raw RGB slots for the images decoded here; the whole
+        # tensor storage is shipped back from the worker and pinned
+        pixels = torch.empty((len(pil_paths), 3, height, width), dtype=torch.uint8)
+        pixel_view = pixels.numpy()
+        encoded = []
+        pixel_filenames = []
+        encoded_filenames = []
+        
+        for img_path in jpeg_paths:
+            try:
+                encoded.append(read_file(str(img_path)))
+                encoded_filenames.append(img_path.name)
+            except Exception as e:
+                print(f"Warning: Could not load {img_path}: {e}")
+        
+        for img_path in pil_paths:
+            try:
+                with Image.open(img_path) as img:
+                    # The slot assignment below would broadcast a W×1 or
+                    # 1×H image instead of rejecting it
+                    if img.size != (width, height):
+                        print(f"Warning: Could not load {img_path}: resolution "
+                              f"{img.width}x{img.height} does not match {width}x{height}")
+                        continue
+
+                    # Ensure RGB format
+                    if img.mode != 'RGB':
+                        img = img.convert('RGB')
+
+                    # Copy the decoded HWC pixels straight into the CHW slot
+                    pixel_view[len(pixel_filenames)] = np.asarray(img).transpose(2, 0, 1)
+                    pixel_filenames.append(img_path.name)
+
+            except Exception as e:
+                print(f"Warning: Could not load {img_path}: {e}")
+        
+        if len(pixel_filenames) < len(pil_paths):
+            # A slice would still ship the unused slots of the full storage
+            pixels = pixels[:len(pixel_filenames)].clone()
+        return pixels, encoded, pixel_filenames + encoded_filenames
+
+def collate_loaded_batch(batch):
+    """
+    Pass through a batch already assembled by ImageFolderDataset
+    """
+    return batch
+
+def decode_with_pil(data):
+    """
+    Decode raw image file bytes on the CPU into a CHW uint8 tensor
+
+    Used for JPEGs that nvJPEG rejects but PIL can read (CMYK, for example).
+    """
+    with Image.open(io.BytesIO(data.numpy().tobytes())) as img:
+        if img.mode != 'RGB':
+            img = img.convert('RGB')
+        return torch.from_numpy(np.asarray(img).transpose(2, 0, 1).copy())
+
+def assemble_batch(pixels, encoded, filenames, device):
+    """
+    Move a loaded uint8 batch to the device, decoding raw JPEGs there
+
+    Decoded images follow the PIL-decoded ones; the returned filenames
+    match the order of the returned batch. The batch stays uint8, so the
+    host-to-device copy moves a quarter of the bytes of a float batch.
+    """
+    num_pixels = pixels.size(0)
+    height, width = pixels.shape[2:]
+    encoded_filenames = filenames[num_pixels:]
+    filenames = filenames[:num_pixels]
+    
+    decoded = []
+    if encoded:
+        try:
+            decoded = decode_jpeg(encoded, mode=ImageReadMode.RGB, device=device)
+        except RuntimeError:
+            # One bad file fails the whole batched decode; retry one by one,
+            # falling back to PIL for files the GPU decoder does not support
+            decoded = []
+            for data, name in zip(encoded, encoded_filenames):
+                try:
+                    decoded.append(decode_jpeg(data, mode=ImageReadMode.RGB, device=device))
+                except RuntimeError:
+                    try:
+                        decoded.append(decode_with_pil(data).to(device))
+                    except Exception as e:
+                        print(f"Warning: Could not load {name}: {e}")
+                        decoded.append(None)
+        
+        valid = []
+        for img, name in zip(decoded, encoded_filenames):
+            if img is None:
+                continue
+            if img.shape[1:] != (height, width):
+                print(f"Warning: Could not load {name}: resolution "
+                      f"{img.shape[2]}x{img.shape[1]} does not match {width}x{height}")
+                continue
+            valid.append(img)
+            filenames.append(name)
+        decoded = valid
+    
+    if not filenames:
+        return None, []
+    
+    # Fill one preallocated device batch rather than stacking a list
+    batch = torch.empty((len(filenames), 3, height, width), dtype=torch.uint8, device=device)
+    batch[:num_pixels].copy_(pixels, non_blocking=True)
+    for i, img in enumerate(decoded, start=num_pixels):
+        batch[i].copy_(img)
+    return batch, filenames
+
+def wait_for_copy(batch, filenames, ready):
+    """
+    Make the current CUDA stream wait until a prefetched batch has arrived
+    """
+    stream = torch.cuda.current_stream()
+    stream.wait_event(ready)
+    if batch is not None:
+        # The batch was allocated on the copy stream; keep its memory alive
+        # until the work queued on this stream is done with it
+        batch.record_stream(stream)
+    return batch, filenames
+
+def prefetch_to_device(loader, device, overlap_streams=False):
+    """
+    Yield batches from the loader moved to the device
+
+    With overlap_streams set on CUDA, batches are moved one ahead: the next
+    batch is copied (and its JPEGs decoded) on a side stream while the
+    current one is being resized on the default stream.
+    """
+    if not (overlap_streams and device == 'cuda'):
+        for pixels, encoded, filenames in loader:
+            yield assemble_batch(pixels, encoded, filenames, device)
+        return
+    
+    copy_stream = torch.cuda.Stream()
+    pending = None
+    for pixels, encoded, filenames in loader:
+        with torch.cuda.stream(copy_stream):
+            batch, filenames = assemble_batch(pixels, encoded, filenames, device)
+            ready = torch.cuda.Event()
+            ready.record()
+        if pending is not None:
+            yield wait_for_copy(*pending)
+        pending = (batch, filenames, ready)
+    
+    if pending is not None:
+        yield wait_for_copy(*pending)
+
+def copy_to_host(batch, stream=None):
+    """
+    Start copying a batch to host memory
+
+    With a side stream, the copy goes into pinned memory asynchronously and
+    the returned event marks its completion; otherwise the copy is done on
+    return and the event is None.
+    """
+    if stream is None:
+        return batch.cpu(), None
+    
+    host_batch = torch.empty(batch.shape, dtype=batch.dtype, pin_memory=True)
+    stream.wait_stream(torch.cuda.current_stream())
+    with torch.cuda.stream(stream):
+        host_batch.copy_(batch, non_blocking=True)
+        batch.record_stream(stream)
+        copied = torch.cuda.Event()
+        copied.record()
+    return host_batch, copied
+
+def save_batch(save_pool, host_batch, copied, output_files):
+    """
+    Wait for a batch to reach host memory, then save its images in parallel
+
+    Returns the number of images saved.
+    """
+    if copied is not None:
+        copied.synchronize()
+    return sum(save_pool.map(save_image, host_batch.numpy(), output_files))
+
+def to_uint8(tensor):
+    """
+    Quantize a [0, 1] float image tensor to uint8
+    """
+    return tensor.mul(255).clamp_(0, 255).to(torch.uint8)
+
+def resize_to_uint8(batch, size, fp16=False):
+    """
+    Resize a uint8 batch in floating point and quantize the result to uint8
+    """
+    batch = batch.half() if fp16 else batch.float()
+    batch = batch.div_(255)
+    return to_uint8(resize(batch, size, antialias=True))
+
+def save_image(img_array, output_file):
+    """
+    Save one HxWx3 uint8 image, returning whether it succeeded
+    """
+    try:
+        if output_file.suffix.lower() in JPEG_EXTENSIONS:
+            # Encode JPEGs straight from the tensor
+            img_tensor = torch.from_numpy(img_array).permute(2, 0, 1)
+            write_file(str(output_file), encode_jpeg(img_tensor))
+        else:
+            Image.fromarray(img_array).save(output_file)
+        return True
+    
+    except Exception as e:
+        print(f"Error saving {output_file.name}: {e}")
+        return False
+
 def batch_resize_same_resolution(input_dir, output_dir, scale_factor=0.5, 
-                                 target_size=None, device='cuda'):
+                                 target_size=None, device='cuda',
+                                 batch_size=64, num_workers=None, fp16=False,
+                                 compile_resize=False, overlap_streams=False,
+                                 gpu_jpeg=False):
     """
     Batch resize images with SAME resolution using GPU
+
+    Images are decoded by DataLoader worker processes and resized in batches,
+    so decoding overlaps with GPU work instead of preceding all of it. With
+    gpu_jpeg set on CUDA, JPEGs are only read from disk by the workers and
+    decoded with nvJPEG, which avoids uploading the much larger raw RGB data;
+    this path is experimental and off by default. With fp16 set, the
+    resize runs in half precision, halving its memory traffic. With
+    compile_resize set, the cast/resize/quantize step is compiled with
+    torch.compile for the fixed batch shape, fusing its kernels (and using
+    CUDA graphs on GPU). With overlap_streams set on CUDA, host/device
+    copies run on side streams and overlap with resizing the neighbouring
+    batches; this path is experimental and off by default.
     """
     input_path = Path(input_dir)
     output_path = Path(output_dir)
@@ -40,6 +302,11 @@ def batch_resize_same_resolution(input_dir, output_dir, scale_factor=0.5,
     
     print(f"Found {len(image_files)} images")
     print(f"Using device: {device}")
+    if fp16:
+        print("Using half precision (FP16) resize")
+    gpu_jpeg = gpu_jpeg and device == 'cuda'
+    if gpu_jpeg:
+        print("Decoding JPEGs on the GPU with nvJPEG (experimental)")
     if device == 'cuda':
         print(f"GPU: {torch.cuda.get_device_name(0)}")
     
@@ -57,88 +324,110 @@ def batch_resize_same_resolution(input_dir, output_dir, scale_factor=0.5,
         
         print(f"Target resolution: {new_width}x{new_height}")
     
-    # Pre-allocate tensor on GPU for maximum speed
+    if num_workers is None:
+        num_workers = min(8, os.cpu_count() or 1)
+    
+    # Decode images in worker processes, batch_size images at a time. The
+    # loader's pin_memory thread copies each batch into page-locked memory;
+    # workers can't allocate it themselves as it doesn't survive IPC.
+    loader = DataLoader(
+        ImageFolderDataset(image_files, original_size, gpu_jpeg=gpu_jpeg),
+        batch_size=batch_size,
+        num_workers=num_workers,
+        pin_memory=(device == 'cuda'),
+        collate_fn=collate_loaded_batch
+    )
+    
     start_time = time.time()
     
-    # Load all images into a single batch tensor
-    print(f"\nLoading all {len(image_files)} images into batch...")
-    batch_tensors = []
-    batch_filenames = []
+    print(f"\nProcessing {len(image_files)} images in batches of {batch_size} "
+          f"({num_workers} loader workers)...")
+    total_images = 0
+    load_time = 0.0
+    gpu_time = 0.0
+    save_time = 0.0
     
-    load_start = time.time()
-    for img_path in image_files:
-        try:
-            with Image.open(img_path) as img:
-                # Ensure RGB format
-                if img.mode != 'RGB':
-                    img = img.convert('RGB')
-                
-                # Convert to tensor and add batch dimension
-                tensor_img = transforms.ToTensor()(img).unsqueeze(0)
-                batch_tensors.append(tensor_img)
-                batch_filenames.append(img_path.name)
-                
-        except Exception as e:
-            print(f"Warning: Could not load {img_path}: {e}")
-            continue
+    # Compile the resize step once; every full batch has the same shape, so
+    # only the last, smaller batch triggers a recompile
+    process = resize_to_uint8
+    if compile_resize:
+        print("Compiling resize step (first batch will be slow)...")
+        process = torch.compile(
+            resize_to_uint8,
+            mode="reduce-overhead" if device == 'cuda' else "default",
+            dynamic=False
+        )
     
-    if not batch_tensors:
-        print("No valid images found!")
-        return
+    # PIL and libjpeg release the GIL while encoding, so saves run in threads
+    save_pool = ThreadPoolExecutor(max_workers=os.cpu_count())
     
-    # Stack all tensors into a single batch
-    batch = torch.cat(batch_tensors, dim=0)
-    batch_size = batch.size(0)
+    progress = tqdm(total=len(image_files), desc="Resizing", unit="img")
     
-    load_time = time.time() - load_start
-    print(f"Batch loaded: {batch_size} images")
-    print(f"Batch tensor shape: {batch.shape}")
-    print(f"Load time: {load_time:.2f}s")
+    # With overlap_streams on CUDA, copies to and from the device run on side
+    # streams, so batch N+1 is uploaded and batch N-1 downloaded while batch
+    # N is resized. Otherwise every copy is synchronous.
+    overlap_streams = overlap_streams and device == 'cuda'
+    if overlap_streams:
+        print("Overlapping host/device copies on CUDA streams (experimental)")
+    d2h_stream = torch.cuda.Stream() if overlap_streams else None
+    pending_save = None
     
-    # Move entire batch to GPU
-    print(f"\nMoving batch to {device}...")
-    gpu_start = time.time()
-    batch = batch.to(device)
+    load_start = time.time()
+    for batch, batch_filenames in prefetch_to_device(loader, device, overlap_streams):
+        load_time += time.time() - load_start
+        if batch is None:
+            load_start = time.time()
+            continue
+        
+        # Resize the whole batch in one call
+        gpu_start = time.time()
+        resized_batch = process(batch, [new_height, new_width], fp16)
+        # Copy the whole batch back in one transfer, as NHWC for PIL. The
+        # contiguous() copy is taken before the next process() call, which
+        # reuses the CUDA graph's output memory when compiled.
+        host_batch, copied = copy_to_host(resized_batch.permute(0, 2, 3, 1).contiguous(),
+                                          d2h_stream)
+        gpu_time += time.time() - gpu_start
+        
+        # Release this chunk's device tensors, so device memory stays bounded
+        # by the batches in flight
+        del batch, resized_batch
+        
+        # Save the previous batch while this one is still being processed
+        save_start = time.time()
+        if pending_save is not None:
+            total_images += save_batch(save_pool, *pending_save)
+            progress.update(len(pending_save[2]))
+        pending_save = (host_batch, copied, [output_path / name for name in batch_filenames])
+        save_time += time.time() - save_start
+        
+        load_start = time.time()
     
-    # Resize entire batch at once (MUCH faster!)
-    print(f"Resizing entire batch on {device}...")
-    resized_batch = resize(batch, [new_height, new_width], antialias=True)
+    if pending_save is not None:
+        save_start = time.time()
+        total_images += save_batch(save_pool, *pending_save)
+        progress.update(len(pending_save[2]))
+        save_time += time.time() - save_start
     
-    gpu_time = time.time() - gpu_start
-    print(f"GPU batch processing time: {gpu_time:.2f}s")
+    save_pool.shutdown()
+    progress.close()
     
-    # Save all images
-    print(f"\nSaving {batch_size} resized images...")
-    save_start = time.time()
+    if not total_images:
+        print("No valid images found!")
+        return
     
-    for i in range(batch_size):
-        try:
-            # Convert tensor back to CPU and then to PIL
-            img_tensor = resized_batch[i].cpu()
-            img_pil = transforms.ToPILImage()(img_tensor)
-            
-            # Save image
-            output_file = output_path / batch_filenames[i]
-            img_pil.save(output_file)
-            
-            if (i + 1) % 10 == 0:
-                print(f"  Saved {i + 1}/{batch_size} images")
-                
-        except Exception as e:
-            print(f"Error saving {batch_filenames[i]}: {e}")
-    
-    save_time = time.time() - save_start
     total_time = time.time() - start_time
     
     print(f"\n{'='*50}")
     print(f"Summary:")
-    print(f"  Total images processed: {batch_size}")
-    print(f"  Load time: {load_time:.2f}s")
+    print(f"  Total images processed: {total_images}")
+    print(f"  Load wait time: {load_time:.2f}s")
     print(f"  GPU processing time: {gpu_time:.2f}s")
     print(f"  Save time: {save_time:.2f}s")
     print(f"  Total time: {total_time:.2f}s")
-    print(f"  Average time per image: {total_time/batch_size:.3f}s")
-    print(f"  Speedup vs sequential: ~{load_time * batch_size / total_time:.1f}x")
+    print(f"  Average time per image: {total_time/total_images:.3f}s")
+    if device == 'cuda':
+        print(f"  Peak GPU memory: {torch.cuda.max_memory_allocated() / 2**20:.0f} MiB")
     print(f"  Output saved to: {output_dir}")
     print(f"{'='*50}")
     
@@ -155,8 +444,22 @@ if __name__ == "__main__":
     parser.add_argument("--width", type=int, help="Target width (overrides scale)")
     parser.add_argument("--height", type=int, help="Target height (overrides scale)")
     parser.add_argument("--cpu", action="store_true", help="Use CPU instead of GPU")
+    parser.add_argument("--batch-size", type=int, default=64,
+                       help="Images resized per batch; bounds GPU memory (default: 64)")
+    parser.add_argument("--fp16", action="store_true",
+                       help="Resize in half precision (faster on GPU)")
+    parser.add_argument("--compile", action="store_true",
+                       help="Compile the resize step with torch.compile")
+    parser.add_argument("--overlap-streams", action="store_true",
+                       help="Overlap host/device copies with resizing on CUDA streams (experimental)")
+    parser.add_argument("--gpu-jpeg", action="store_true",
+                       help="Decode JPEGs on the GPU with nvJPEG (experimental)")
+    parser.add_argument("--workers", type=int,
+                       help="Image loader worker processes (default: min(8, CPU count))")
     
     args = parser.parse_args()
+    if args.batch_size < 1:
+        parser.error("--batch-size must be at least 1")
     
     # Set device
     device = 'cpu' if args.cpu else 'cuda'
@@ -172,5 +475,11 @@ if __name__ == "__main__":
         args.output_dir,
         scale_factor=args.scale,
         target_size=target_size,
-        device=device
+        device=device,
+        batch_size=args.batch_size,
+        num_workers=args.workers,
+        fp16=args.fp16,
+        compile_resize=args.compile,
+        overlap_streams=args.overlap_streams,
+        gpu_jpeg=args.gpu_jpeg
     )